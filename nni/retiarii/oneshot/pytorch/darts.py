@@ -2,6 +2,7 @@
 # Licensed under the MIT license.
 
 import copy
+import functools
 import logging
 from collections import OrderedDict
 
@@ -10,23 +11,133 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ..interface import BaseOneShotTrainer
-from .utils import AverageMeterGroup, replace_layer_choice, replace_input_choice, to_device
+from .utils import AverageMeterGroup, all_reduce_grads, exclude_params_from_ddp, \
+    replace_layer_choice, replace_input_choice, to_device
 
 
 _logger = logging.getLogger(__name__)
 
 
+def _weighted_sum(alpha, tensors):
+    # softmax-weighted sum accumulated tensor by tensor; stacking the candidates
+    # first would cost an extra (N+1)x allocation and memory pass
+    weights = F.softmax(alpha, -1)
+    res = tensors[0] * weights[0]
+    for tensor, weight in zip(tensors[1:], weights[1:]):
+        res = res + tensor * weight
+    return res
+
+
+def _compile_weighted_sum():
+    # torch.compile fuses the softmax + broadcast-mul + add chain into one
+    # kernel; it appeared in torch 2.0, so silently fall back to eager before that
+    if hasattr(torch, 'compile'):
+        return torch.compile(_weighted_sum, dynamic=False, mode='reduce-overhead')
+    _logger.warning('torch.compile is not available in this torch version; using the eager mixture instead.')
+    return _weighted_sum
+
+
+def _get_rng_states(device):
+    states = [torch.get_rng_state()]
+    if device.type == 'cuda':
+        states.append(torch.cuda.get_rng_state(device))
+    return states
+
+
+def _set_rng_states(states, device):
+    torch.set_rng_state(states[0])
+    if device.type == 'cuda':
+        torch.cuda.set_rng_state(states[1], device)
+
+
+def _record_stream(obj, stream):
+    # tensors copied on a side stream must be recorded on the consumer stream,
+    # otherwise the caching allocator may reuse their memory too early
+    if torch.is_tensor(obj):
+        obj.record_stream(stream)
+    elif isinstance(obj, (list, tuple)):
+        for o in obj:
+            _record_stream(o, stream)
+    elif isinstance(obj, dict):
+        for o in obj.values():
+            _record_stream(o, stream)
+
+
+class DartsMixtureFunction(torch.autograd.Function):
+    """
+    Memory-efficient weighted mixture of candidate ops.
+
+    Forward runs every op under ``no_grad`` and only keeps the accumulated weighted sum,
+    so at most one branch activation is alive at a time instead of all N of them.
+    Backward recomputes each branch (checkpoint-style) to obtain its gradients,
+    trading a second forward per branch for O(N) less activation memory per mixed layer.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weights, ops, *op_params):
+        # ``op_params`` are only passed so that autograd knows the op parameters
+        # are inputs of this Function; backward retrieves them from the ops directly
+        ctx.ops = ops
+        # stash the RNG state before each branch so ops with randomness (e.g.
+        # dropout) are recomputed against the same realization during backward
+        ctx.rng_devices = [x.device] if x.device.type == 'cuda' else []
+        ctx.rng_states = []
+        with torch.no_grad():
+            res = None
+            for weight, op in zip(weights, ops):
+                ctx.rng_states.append(_get_rng_states(x.device))
+                op_result = op(x) * weight
+                res = op_result if res is None else res + op_result
+        ctx.save_for_backward(x, weights)
+        return res
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, weights = ctx.saved_tensors
+        grad_x = None
+        grad_weights = torch.zeros_like(weights)
+        param_grads = []
+        for i, op in enumerate(ctx.ops):
+            with torch.random.fork_rng(devices=ctx.rng_devices):
+                _set_rng_states(ctx.rng_states[i], x.device)
+                with torch.enable_grad():
+                    branch_x = x.detach().requires_grad_()
+                    branch_out = op(branch_x)
+            params = [p for p in op.parameters() if p.requires_grad]
+            grads = torch.autograd.grad(branch_out, [branch_x] + params,
+                                        grad_output * weights[i], allow_unused=True)
+            if grads[0] is not None:
+                grad_x = grads[0] if grad_x is None else grad_x + grads[0]
+            param_grads.extend(grads[1:])
+            with torch.no_grad():
+                grad_weights[i] = torch.sum(grad_output * branch_out)
+        return (grad_x, grad_weights, None) + tuple(param_grads)
+
+    @staticmethod
+    def apply_with_params(x, weights, ops):
+        # expose op parameters as inputs of the Function so that autograd
+        # routes the recomputed branch gradients back to them
+        op_params = [p for op in ops for p in op.parameters() if p.requires_grad]
+        return DartsMixtureFunction.apply(x, weights, ops, *op_params)
+
+
 class DartsLayerChoice(nn.Module):
-    def __init__(self, layer_choice):
+    def __init__(self, layer_choice, memory_efficient=False, use_compile=False):
         super(DartsLayerChoice, self).__init__()
         self.name = layer_choice.label
         self.op_choices = nn.ModuleDict(OrderedDict([(name, layer_choice[name]) for name in layer_choice.names]))
         self.alpha = nn.Parameter(torch.randn(len(self.op_choices)) * 1e-3)
+        self.memory_efficient = memory_efficient
+        # the candidate set is fixed after construction; cache the values view
+        # so forward does not rebuild it on every call
+        self._ops_list = list(self.op_choices.values())
+        self._mix = _compile_weighted_sum() if use_compile else _weighted_sum
 
     def forward(self, *args, **kwargs):
-        op_results = torch.stack([op(*args, **kwargs) for op in self.op_choices.values()])
-        alpha_shape = [-1] + [1] * (len(op_results.size()) - 1)
-        return torch.sum(op_results * F.softmax(self.alpha, -1).view(*alpha_shape), 0)
+        if self.memory_efficient and torch.is_grad_enabled() and \
+                len(args) == 1 and not kwargs and torch.is_tensor(args[0]):
+            return DartsMixtureFunction.apply_with_params(args[0], F.softmax(self.alpha, -1), self._ops_list)
+        return self._mix(self.alpha, [op(*args, **kwargs) for op in self._ops_list])
 
     def parameters(self):
         for _, p in self.named_parameters():
@@ -43,16 +154,15 @@ class DartsLayerChoice(nn.Module):
 
 
 class DartsInputChoice(nn.Module):
-    def __init__(self, input_choice):
+    def __init__(self, input_choice, use_compile=False):
         super(DartsInputChoice, self).__init__()
         self.name = input_choice.label
         self.alpha = nn.Parameter(torch.randn(input_choice.n_candidates) * 1e-3)
         self.n_chosen = input_choice.n_chosen or 1
+        self._mix = _compile_weighted_sum() if use_compile else _weighted_sum
 
     def forward(self, inputs):
-        inputs = torch.stack(inputs)
-        alpha_shape = [-1] + [1] * (len(inputs.size()) - 1)
-        return torch.sum(inputs * F.softmax(self.alpha, -1).view(*alpha_shape), 0)
+        return self._mix(self.alpha, inputs)
 
     def parameters(self):
         for _, p in self.named_parameters():
@@ -65,7 +175,7 @@ class DartsInputChoice(nn.Module):
             yield name, p
 
     def export(self):
-        return torch.argsort(-self.alpha).cpu().numpy().tolist()[:self.n_chosen]
+        return torch.topk(self.alpha, self.n_chosen).indices.cpu().tolist()
 
 
 class DartsTrainer(BaseOneShotTrainer):
@@ -102,13 +212,23 @@ class DartsTrainer(BaseOneShotTrainer):
         Learning rate of architecture parameters.
     unrolled : float
         ``True`` if using second order optimization, else first order optimization.
+    memory_efficient : bool
+        If true, layer choices recompute their branches during backward instead of
+        keeping every branch activation alive (see ``DartsMixtureFunction``).
+        Saves roughly a factor of N activation memory per mixed layer at the cost
+        of one extra forward per branch.
+    use_compile : bool
+        If true, the mixture expression of layer and input choices is compiled
+        with ``torch.compile`` into a fused kernel. Ignored (with a warning) on
+        torch versions without ``torch.compile``.
     """
 
     def __init__(self, model, loss, metrics, optimizer,
                  num_epochs, dataset, grad_clip=5.,
                  learning_rate=2.5E-3, batch_size=64, workers=4,
                  device=None, log_frequency=None,
-                 arc_learning_rate=3.0E-4, unrolled=False):
+                 arc_learning_rate=3.0E-4, unrolled=False,
+                 memory_efficient=False, use_compile=False):
         self.model = model
         self.loss = loss
         self.metrics = metrics
@@ -121,8 +241,12 @@ class DartsTrainer(BaseOneShotTrainer):
         self.model.to(self.device)
 
         self.nas_modules = []
-        replace_layer_choice(self.model, DartsLayerChoice, self.nas_modules)
-        replace_input_choice(self.model, DartsInputChoice, self.nas_modules)
+        replace_layer_choice(self.model,
+                             functools.partial(DartsLayerChoice, memory_efficient=memory_efficient,
+                                               use_compile=use_compile),
+                             self.nas_modules)
+        replace_input_choice(self.model, functools.partial(DartsInputChoice, use_compile=use_compile),
+                             self.nas_modules)
         for _, module in self.nas_modules:
             module.to(self.device)
 
@@ -135,10 +259,17 @@ class DartsTrainer(BaseOneShotTrainer):
                 m.alpha = ctrl_params[m.name]
             else:
                 ctrl_params[m.name] = m.alpha
-        self.ctrl_optim = torch.optim.Adam(list(ctrl_params.values()), arc_learning_rate, betas=(0.5, 0.999),
+        self.ctrl_params = list(ctrl_params.values())
+        self.ctrl_optim = torch.optim.Adam(self.ctrl_params, arc_learning_rate, betas=(0.5, 0.999),
                                            weight_decay=1.0E-3)
+        # alphas are synchronised explicitly in one bucket per architecture step;
+        # keep DDP's per-parameter bucketing off them if the model gets wrapped
+        exclude_params_from_ddp(self.model, self.ctrl_params)
         self.unrolled = unrolled
         self.grad_clip = 5.
+        # side stream for overlapping the train-batch H2D copy with the architecture
+        # step; created on self.device, which is not necessarily the current device
+        self._copy_stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
 
         self._init_dataloader()
 
@@ -148,21 +279,33 @@ class DartsTrainer(BaseOneShotTrainer):
         indices = list(range(n_train))
         train_sampler = torch.utils.data.sampler.SubsetRandomSampler(indices[:split])
         valid_sampler = torch.utils.data.sampler.SubsetRandomSampler(indices[split:])
-        self.train_loader = torch.utils.data.DataLoader(self.dataset,
-                                                        batch_size=self.batch_size,
-                                                        sampler=train_sampler,
-                                                        num_workers=self.workers)
-        self.valid_loader = torch.utils.data.DataLoader(self.dataset,
-                                                        batch_size=self.batch_size,
-                                                        sampler=valid_sampler,
-                                                        num_workers=self.workers)
+        # pinned host memory enables async H2D copies; persistent workers avoid
+        # re-spawning the worker processes at the start of every epoch
+        loader_kwargs = dict(batch_size=self.batch_size,
+                             num_workers=self.workers,
+                             pin_memory=(self.device.type == 'cuda'))
+        if self.workers > 0:
+            loader_kwargs['persistent_workers'] = True
+        self.train_loader = torch.utils.data.DataLoader(self.dataset, sampler=train_sampler, **loader_kwargs)
+        self.valid_loader = torch.utils.data.DataLoader(self.dataset, sampler=valid_sampler, **loader_kwargs)
+        # len(DataLoader) recomputes from the sampler on every call; cache it
+        # as it is queried at every logged step
+        self._steps_per_epoch = min(len(self.train_loader), len(self.valid_loader))
 
     def _train_one_epoch(self, epoch):
         self.model.train()
         meters = AverageMeterGroup()
         for step, ((trn_X, trn_y), (val_X, val_y)) in enumerate(zip(self.train_loader, self.valid_loader)):
-            trn_X, trn_y = to_device(trn_X, self.device), to_device(trn_y, self.device)
-            val_X, val_y = to_device(val_X, self.device), to_device(val_y, self.device)
+            val_X, val_y = to_device(val_X, self.device, non_blocking=True), to_device(val_y, self.device, non_blocking=True)
+            # the train batch is not needed before phase 2 (unless unrolled), so its
+            # copy can be issued on a side stream and hidden behind phase 1's compute
+            overlap_copy = self._copy_stream is not None and not self.unrolled
+            if overlap_copy:
+                with torch.cuda.device(self.device), torch.cuda.stream(self._copy_stream):
+                    trn_X, trn_y = to_device(trn_X, self.device, non_blocking=True), \
+                        to_device(trn_y, self.device, non_blocking=True)
+            else:
+                trn_X, trn_y = to_device(trn_X, self.device), to_device(trn_y, self.device)
 
             # phase 1. architecture step
             self.ctrl_optim.zero_grad()
@@ -170,8 +313,14 @@ class DartsTrainer(BaseOneShotTrainer):
                 self._unrolled_backward(trn_X, trn_y, val_X, val_y)
             else:
                 self._backward(val_X, val_y)
+            all_reduce_grads(self.ctrl_params)
             self.ctrl_optim.step()
 
+            if overlap_copy:
+                compute_stream = torch.cuda.current_stream(self.device)
+                compute_stream.wait_stream(self._copy_stream)
+                _record_stream((trn_X, trn_y), compute_stream)
+
             # phase 2: child network step
             self.model_optim.zero_grad()
             logits, loss = self._logits_and_loss(trn_X, trn_y)
@@ -181,11 +330,12 @@ class DartsTrainer(BaseOneShotTrainer):
             self.model_optim.step()
 
             metrics = self.metrics(logits, trn_y)
-            metrics['loss'] = loss.item()
+            # hand the meter the detached tensor; it syncs once at log time
+            metrics['loss'] = loss.detach()
             meters.update(metrics)
             if self.log_frequency is not None and step % self.log_frequency == 0:
                 _logger.info('Epoch [%s/%s] Step [%s/%s]  %s', epoch + 1,
-                             self.num_epochs, step + 1, len(self.train_loader), meters)
+                             self.num_epochs, step + 1, self._steps_per_epoch, meters)
 
     def _logits_and_loss(self, X, y):
         logits = self.model(X)
@@ -194,10 +344,16 @@ class DartsTrainer(BaseOneShotTrainer):
 
     def _backward(self, val_X, val_y):
         """
-        Simple backward with gradient descent
+        Simple backward with gradient descent.
+        The first-order approximation only needs gradients w.r.t. the architecture
+        parameters; a full backward would also compute weight gradients that the
+        weight phase immediately zeroes out, roughly doubling the backward cost.
         """
         _, loss = self._logits_and_loss(val_X, val_y)
-        loss.backward()
+        grads = torch.autograd.grad(loss, self.ctrl_params, allow_unused=True)
+        for param, grad in zip(self.ctrl_params, grads):
+            if grad is not None:
+                param.grad = grad
 
     def _unrolled_backward(self, trn_X, trn_y, val_X, val_y):
         """
@@ -280,6 +436,16 @@ class DartsTrainer(BaseOneShotTrainer):
     @torch.no_grad()
     def export(self):
         result = dict()
+        # batch the argmax of all layer choices into a single device-to-host
+        # transfer instead of one sync per module
+        layer_choices = OrderedDict()
+        for name, module in self.nas_modules:
+            if name not in layer_choices and isinstance(module, DartsLayerChoice):
+                layer_choices[name] = module
+        if layer_choices:
+            indices = torch.stack([m.alpha.argmax() for m in layer_choices.values()]).cpu().tolist()
+            for (name, module), index in zip(layer_choices.items(), indices):
+                result[name] = list(module.op_choices.keys())[index]
         for name, module in self.nas_modules:
             if name not in result:
                 result[name] = module.export()
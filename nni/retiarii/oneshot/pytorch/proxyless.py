@@ -8,7 +8,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ..interface import BaseOneShotTrainer
-from .utils import AverageMeterGroup, replace_layer_choice, replace_input_choice, to_device
+from .utils import AverageMeterGroup, all_reduce_grads, exclude_params_from_ddp, \
+    replace_layer_choice, replace_input_choice, to_device
 
 
 _logger = logging.getLogger(__name__)
@@ -19,6 +20,7 @@ class ArchGradientFunction(torch.autograd.Function):
     def forward(ctx, x, binary_gates, run_func, backward_func):
         ctx.run_func = run_func
         ctx.backward_func = backward_func
+        ctx.set_materialize_grads(False)
 
         detached_x = x.detach()
         detached_x.requires_grad = x.requires_grad
@@ -29,13 +31,20 @@ class ArchGradientFunction(torch.autograd.Function):
 
     @staticmethod
     def backward(ctx, grad_output):
+        if grad_output is None:
+            return None, None, None, None
         detached_x, output = ctx.saved_tensors
 
-        grad_x = torch.autograd.grad(output, detached_x, grad_output, only_inputs=True)
-        # compute gradients w.r.t. binary_gates
-        binary_grads = ctx.backward_func(detached_x.data, output.data, grad_output.data)
+        grad_x = None
+        if ctx.needs_input_grad[0]:
+            grad_x = torch.autograd.grad(output, detached_x, grad_output, only_inputs=True)[0]
+        # compute gradients w.r.t. binary_gates only when they are needed:
+        # backward_func runs every candidate op once, which is the expensive part
+        binary_grads = None
+        if ctx.needs_input_grad[1]:
+            binary_grads = ctx.backward_func(detached_x.data, output.data, grad_output.data)
 
-        return grad_x[0], binary_grads, None, None
+        return grad_x, binary_grads, None, None
 
 
 class ProxylessLayerChoice(nn.Module):
@@ -45,8 +54,18 @@ class ProxylessLayerChoice(nn.Module):
         self.alpha = nn.Parameter(torch.randn(len(self.ops)) * 1E-3)
         self._binary_gates = nn.Parameter(torch.randn(len(self.ops)) * 1E-3)
         self.sampled = None
+        self._cached_probs = None
+        self._probs_version = -1
 
     def forward(self, *args):
+        assert len(args) == 1
+        x = args[0]
+        if not (self._binary_gates.requires_grad and torch.is_grad_enabled()):
+            # gate gradients are not wanted here (weight phase or inference);
+            # run the sampled op directly instead of going through the custom
+            # Function, which detaches the input and yields no parameter grads
+            return self.ops[self.sampled](x)
+
         def run_function(ops, active_id):
             def forward(_x):
                 return ops[active_id](_x)
@@ -54,32 +73,43 @@ class ProxylessLayerChoice(nn.Module):
 
         def backward_function(ops, active_id, binary_gates):
             def backward(_x, _output, grad_output):
-                binary_grads = torch.zeros_like(binary_gates.data)
                 with torch.no_grad():
-                    for k in range(len(ops)):
-                        if k != active_id:
-                            out_k = ops[k](_x.data)
-                        else:
-                            out_k = _output.data
-                        grad_k = torch.sum(out_k * grad_output)
-                        binary_grads[k] = grad_k
+                    outs = [_output.data if k == active_id else ops[k](_x.data) for k in range(len(ops))]
+                    # <out_k, grad_output> for all k in one [N, M] x [M] matvec,
+                    # instead of N separate multiply+sum kernels
+                    stacked = torch.stack([out.reshape(-1) for out in outs])
+                    binary_grads = stacked.mv(grad_output.reshape(-1))
                 return binary_grads
             return backward
 
-        assert len(args) == 1
-        x = args[0]
         return ArchGradientFunction.apply(
             x, self._binary_gates, run_function(self.ops, self.sampled),
             backward_function(self.ops, self.sampled, self._binary_gates)
         )
 
     def resample(self):
-        probs = F.softmax(self.alpha, dim=-1)
+        probs = self._probs()
         sample = torch.multinomial(probs, 1)[0].item()
+        self.set_sample(sample, probs)
+
+    def set_sample(self, sample, probs):
+        """
+        Activate candidate op ``sample``, with ``probs`` the softmax of alpha it
+        was drawn from. Used by ``resample`` and by the trainer's batched
+        resampling; the cached ``probs`` is reused by ``finalize_grad`` and
+        ``export_prob`` until alpha changes.
+        """
         self.sampled = sample
+        self._cached_probs = probs
+        self._probs_version = self.alpha._version
         with torch.no_grad():
             self._binary_gates.zero_()
-            self._binary_gates.grad = torch.zeros_like(self._binary_gates.data)
+            # reuse the gradient buffer across steps; allocating a fresh tensor
+            # here churned the caching allocator once per mixed layer per step
+            if self._binary_gates.grad is None:
+                self._binary_gates.grad = torch.zeros_like(self._binary_gates.data)
+            else:
+                self._binary_gates.grad.zero_()
             self._binary_gates.data[sample] = 1.0
 
     def finalize_grad(self):
@@ -87,16 +117,33 @@ class ProxylessLayerChoice(nn.Module):
         with torch.no_grad():
             if self.alpha.grad is None:
                 self.alpha.grad = torch.zeros_like(self.alpha.data)
-            probs = F.softmax(self.alpha, dim=-1)
-            for i in range(len(self.ops)):
-                for j in range(len(self.ops)):
-                    self.alpha.grad[i] += binary_grads[j] * probs[j] * (int(i == j) - probs[i])
+            probs = self._probs()
+            # J^T g with softmax Jacobian J_ij = p_j (delta_ij - p_i) collapses to
+            # p_i (g_i - p.g), replacing the N^2 loop with one fused vector expression
+            self.alpha.grad += probs * (binary_grads - torch.dot(binary_grads, probs))
+
+    def arch_requires_grad(self, enabled=True):
+        """
+        Toggle whether gradients w.r.t. binary gates are computed. When disabled,
+        ``ArchGradientFunction.backward`` skips the N - 1 extra branch forwards
+        that are only needed for architecture updates.
+        """
+        self._binary_gates.requires_grad_(enabled)
+
+    def _probs(self):
+        # resample, finalize_grad and export_prob all want softmax(alpha) of the
+        # same step; recompute only when an in-place update of alpha (e.g. an
+        # optimizer step) has bumped its version counter since the cache was filled
+        if self._cached_probs is None or self._probs_version != self.alpha._version:
+            self._cached_probs = F.softmax(self.alpha, dim=-1).detach()
+            self._probs_version = self.alpha._version
+        return self._cached_probs
 
     def export(self):
         return torch.argmax(self.alpha).item()
 
     def export_prob(self):
-        return F.softmax(self.alpha, dim=-1)
+        return self._probs()
 
 
 class ProxylessInputChoice(nn.Module):
@@ -258,8 +305,20 @@ class ProxylessTrainer(BaseOneShotTrainer):
 
         self.optimizer = optimizer
         # we do not support deduplicate control parameters with same label (like DARTS) yet.
-        self.ctrl_optim = torch.optim.Adam([m.alpha for _, m in self.nas_modules], arc_learning_rate,
+        self.ctrl_params = [m.alpha for _, m in self.nas_modules]
+        self.ctrl_optim = torch.optim.Adam(self.ctrl_params, arc_learning_rate,
                                            weight_decay=0, betas=(0, 0.999), eps=1e-8)
+        # modules whose alpha has the same length can be resampled together with
+        # a single batched softmax + multinomial, see _resample_all
+        groups = {}
+        for _, module in self.nas_modules:
+            groups.setdefault(module.alpha.numel(), []).append(module)
+        self._module_groups = list(groups.values())
+        # alphas are synchronised explicitly in one bucket per architecture step,
+        # and gate gradients are sample-specific by design; keep DDP's bucketing
+        # off both if the model gets wrapped
+        exclude_params_from_ddp(self.model,
+                                self.ctrl_params + [m._binary_gates for _, m in self.nas_modules])
         self._init_dataloader()
 
     def _init_dataloader(self):
@@ -268,48 +327,71 @@ class ProxylessTrainer(BaseOneShotTrainer):
         indices = list(range(n_train))
         train_sampler = torch.utils.data.sampler.SubsetRandomSampler(indices[:split])
         valid_sampler = torch.utils.data.sampler.SubsetRandomSampler(indices[split:])
-        self.train_loader = torch.utils.data.DataLoader(self.dataset,
-                                                        batch_size=self.batch_size,
-                                                        sampler=train_sampler,
-                                                        num_workers=self.workers)
-        self.valid_loader = torch.utils.data.DataLoader(self.dataset,
-                                                        batch_size=self.batch_size,
-                                                        sampler=valid_sampler,
-                                                        num_workers=self.workers)
+        # pinned host memory enables async H2D copies; persistent workers avoid
+        # re-spawning the worker processes at the start of every epoch
+        loader_kwargs = dict(batch_size=self.batch_size,
+                             num_workers=self.workers,
+                             pin_memory=(self.device.type == 'cuda'))
+        if self.workers > 0:
+            loader_kwargs['persistent_workers'] = True
+        self.train_loader = torch.utils.data.DataLoader(self.dataset, sampler=train_sampler, **loader_kwargs)
+        self.valid_loader = torch.utils.data.DataLoader(self.dataset, sampler=valid_sampler, **loader_kwargs)
+        # len(DataLoader) recomputes from the sampler on every call; cache it
+        # as it is queried at every logged step
+        self._steps_per_epoch = min(len(self.train_loader), len(self.valid_loader))
 
     def _train_one_epoch(self, epoch):
         self.model.train()
         meters = AverageMeterGroup()
         for step, ((trn_X, trn_y), (val_X, val_y)) in enumerate(zip(self.train_loader, self.valid_loader)):
-            trn_X, trn_y = to_device(trn_X, self.device), to_device(trn_y, self.device)
-            val_X, val_y = to_device(val_X, self.device), to_device(val_y, self.device)
+            trn_X, trn_y = to_device(trn_X, self.device, non_blocking=True), to_device(trn_y, self.device, non_blocking=True)
+            val_X, val_y = to_device(val_X, self.device, non_blocking=True), to_device(val_y, self.device, non_blocking=True)
 
             if epoch >= self.warmup_epochs:
                 # 1) train architecture parameters
                 for _, module in self.nas_modules:
-                    module.resample()
+                    module.arch_requires_grad(True)
+                self._resample_all()
                 self.ctrl_optim.zero_grad()
                 logits, loss = self._logits_and_loss_for_arch_update(val_X, val_y)
                 loss.backward()
                 for _, module in self.nas_modules:
                     module.finalize_grad()
+                all_reduce_grads(self.ctrl_params)
                 self.ctrl_optim.step()
 
             # 2) train model parameters
+            # gate gradients are not needed here; disabling them lets the custom
+            # backward skip the extra branch forwards
             for _, module in self.nas_modules:
-                module.resample()
+                module.arch_requires_grad(False)
+            self._resample_all()
             self.optimizer.zero_grad()
             logits, loss = self._logits_and_loss_for_weight_update(trn_X, trn_y)
             loss.backward()
             self.optimizer.step()
             metrics = self.metrics(logits, trn_y)
-            metrics["loss"] = loss.item()
+            # hand the meter the detached tensor; it syncs once at log time
+            metrics["loss"] = loss.detach()
             if self.latency_estimator:
                 metrics["latency"] = self._export_latency()
             meters.update(metrics)
             if self.log_frequency is not None and step % self.log_frequency == 0:
                 _logger.info("Epoch [%s/%s] Step [%s/%s]  %s", epoch + 1,
-                             self.num_epochs, step + 1, len(self.train_loader), meters)
+                             self.num_epochs, step + 1, self._steps_per_epoch, meters)
+
+    def _resample_all(self):
+        # one softmax + multinomial (and one host sync) per group of same-sized
+        # alphas, instead of a kernel pair and an .item() per module
+        with torch.no_grad():
+            for group in self._module_groups:
+                if len(group) == 1:
+                    group[0].resample()
+                    continue
+                probs = F.softmax(torch.stack([m.alpha for m in group]), dim=-1)
+                samples = torch.multinomial(probs, 1).squeeze(1).tolist()
+                for module, sample, module_probs in zip(group, samples, probs):
+                    module.set_sample(sample, module_probs)
 
     def _logits_and_loss_for_arch_update(self, X, y):
         ''' return logits and loss for architecture parameter update '''
@@ -347,10 +429,11 @@ class ProxylessTrainer(BaseOneShotTrainer):
         return logits, loss
 
     def _export_latency(self):
-        current_architecture = {}
-        for module_name, module in self.nas_modules:
-            selected_module = module.export()
-            current_architecture[module_name] = selected_module
+        # this runs every logged step; batch the argmax of all modules into one
+        # device-to-host transfer instead of a sync per module
+        with torch.no_grad():
+            indices = torch.stack([module.alpha.argmax() for _, module in self.nas_modules]).cpu().tolist()
+        current_architecture = {name: index for (name, _), index in zip(self.nas_modules, indices)}
         return self.latency_estimator.export_latency(current_architecture)
 
     def fit(self):
@@ -0,0 +1,54 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from nni.retiarii.oneshot.pytorch.darts import _weighted_sum, _compile_weighted_sum
+from nni.retiarii.oneshot.pytorch.proxyless import ProxylessLayerChoice
+
+
+def _stacked_weighted_sum(alpha, tensors):
+    # the original stack-multiply-sum formulation, kept as numeric reference
+    stacked = torch.stack(list(tensors))
+    alpha_shape = [-1] + [1] * (len(stacked.size()) - 1)
+    return torch.sum(stacked * F.softmax(alpha, -1).view(*alpha_shape), 0)
+
+
+def test_weighted_sum_matches_stacked():
+    torch.manual_seed(0)
+    alpha = torch.randn(4)
+    tensors = [torch.randn(2, 3, 5, 5) for _ in range(4)]
+    expected = _stacked_weighted_sum(alpha, tensors)
+    assert torch.allclose(_weighted_sum(alpha, tensors), expected, atol=1e-6)
+
+
+def test_weighted_sum_compiled_matches_eager():
+    if not hasattr(torch, 'compile'):
+        pytest.skip('torch.compile is not available in this torch version')
+    torch.manual_seed(0)
+    alpha = torch.randn(4)
+    tensors = [torch.randn(2, 3, 5, 5) for _ in range(4)]
+    compiled = _compile_weighted_sum()
+    assert torch.allclose(compiled(alpha, tensors), _weighted_sum(alpha, tensors), atol=1e-5)
+
+
+def test_proxyless_finalize_grad_matches_double_loop():
+    torch.manual_seed(0)
+    num_ops = 3
+    choice = ProxylessLayerChoice([nn.Linear(4, 4) for _ in range(num_ops)])
+    binary_grads = torch.randn(num_ops)
+    choice._binary_gates.grad = binary_grads.clone()
+    choice.finalize_grad()
+    probs = F.softmax(choice.alpha, dim=-1)
+    expected = torch.zeros(num_ops)
+    with torch.no_grad():
+        for i in range(num_ops):
+            for j in range(num_ops):
+                expected[i] += binary_grads[j] * probs[j] * (int(i == j) - probs[i])
+    assert torch.allclose(choice.alpha.grad, expected, atol=1e-6)
+
+
+if __name__ == '__main__':
+    test_weighted_sum_matches_stacked()
+    test_weighted_sum_compiled_matches_eager()
+    test_proxyless_finalize_grad_matches_double_loop()